@@ -2,115 +2,289 @@
 """
 Kubernetes Audit Log Analyzer for Rancher Multi-Cluster Setup
 Analyzes audit logs to understand API request patterns from Rancher clusters
+
+Requires Python 3.10+ (dataclass slots, int.bit_count). orjson is used when
+installed, and uri_parse.pyx is used when built next to this script.
 """
 
+import functools
+import hashlib
+import heapq
+import io
 import json
+import mmap
+import multiprocessing
+import os
+import stat
 import sys
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, namedtuple
+from dataclasses import dataclass, field
 from datetime import datetime
 import re
-from urllib.parse import urlparse, parse_qs
+
+if sys.version_info < (3, 10):
+    sys.exit("audit-run.py requires Python 3.10 or newer")
+
+# orjson is much faster on large audit logs; fall back to stdlib json if missing
+try:
+    import orjson
+    json_loads = orjson.loads
+except ImportError:
+    json_loads = json.loads
+
+# Pattern: system:serviceaccount:cattle-system-{cluster_id}:cattle-{cluster_id}
+_CATTLE_RE = re.compile(r'cattle-system-([^:]+):cattle-([^:]+)')
+_SYSTEM_USERS = frozenset(('kwok-admin', 'system:apiserver'))
+
+# Only completed requests are analyzed. RequestReceived events duplicate them
+# and can be recognized before decoding: the apiserver writes compact JSON with
+# "stage" among the first few fields, ahead of any request/response objects.
+_OK_STAGES = frozenset(('ResponseComplete', 'ResponseStarted'))
+_REQUEST_RECEIVED = b'"stage":"RequestReceived"'
+_STAGE_SCAN_BYTES = 256
+
+# Files smaller than this are analyzed in-process; worker startup and merging
+# would cost more than they save
+PARALLEL_MIN_BYTES = 64 * 1024 * 1024
+
+# Endpoints an EndpointCounter keeps when it prunes (counts are exact up to
+# twice this many), and the size of its hash sample for overlap detection
+ENDPOINT_CAPACITY = 1024
+ENDPOINT_SAMPLE_SIZE = 1024
+
+ResourceInfo = namedtuple('ResourceInfo', 'api_group version resource namespaced namespace')
+
+def iter_lines(mm, start=0, end=None):
+    """Yield raw lines from a memory-mapped file between byte offsets start and end"""
+    if end is None:
+        end = len(mm)
+    while start < end:
+        nl = mm.find(b'\n', start, end)
+        if nl < 0:
+            # Last line without a trailing newline
+            nl = end
+        yield mm[start:nl]
+        start = nl + 1
+
+def chunk_bounds(mm, count):
+    """Split a memory-mapped file into at most count (start, end) ranges on line boundaries"""
+    size = len(mm)
+    offsets = [0]
+    for i in range(1, count):
+        nl = mm.find(b'\n', max(size * i // count, offsets[-1]))
+        if nl < 0:
+            break
+        if nl + 1 > offsets[-1]:
+            offsets.append(nl + 1)
+    offsets.append(size)
+    return [(start, end) for start, end in zip(offsets, offsets[1:]) if start < end]
+
+def _analyze_chunk(args):
+    """Worker: analyze one byte range of the audit log and return the partial result"""
+    filename, start, end = args
+    analyzer = RancherAuditAnalyzer()
+    with open(filename, 'rb') as f, mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+        line_count = analyzer.analyze_lines(iter_lines(mm, start, end), report_progress=False)
+    return analyzer, line_count
+
+def _endpoint_hash(endpoint):
+    """64-bit hash of an endpoint that is stable across worker processes"""
+    return int.from_bytes(hashlib.blake2b(endpoint.encode(), digest_size=8).digest(), 'little')
+
+class EndpointCounter(dict):
+    """Bounded endpoint -> request count mapping for high-cardinality URIs
+
+    Counts are exact until more than 2 * ENDPOINT_CAPACITY distinct endpoints
+    have been seen. Past that, it prunes in batches (Misra-Gries): every count
+    drops by the (capacity + 1)-th largest count, and keys reaching zero are
+    removed. A kept count is then a lower bound on the true count, at most
+    `error` below it; endpoints that were dropped had at most `error` requests.
+
+    Every distinct endpoint is also offered to a bottom-k sample of stable
+    hashes (the ENDPOINT_SAMPLE_SIZE smallest). Overlap between clusters is
+    estimated from that sample, which is exact while a cluster has at most
+    that many distinct endpoints.
+    """
+    
+    def __init__(self, capacity=ENDPOINT_CAPACITY, sample_size=ENDPOINT_SAMPLE_SIZE):
+        super().__init__()
+        self.capacity = capacity
+        self.error = 0
+        self.sample_size = sample_size
+        self.sample = set()
+        self._sample_heap = []  # negated hashes, so [0] is the largest kept
+        
+    def __missing__(self, key):
+        # Only reached for endpoints not currently counted, so the hot
+        # "seen before" path stays a plain dict update
+        self._offer(_endpoint_hash(key))
+        if len(self) >= 2 * self.capacity:
+            self._prune()
+        return 0
+        
+    def _offer(self, h):
+        sample = self.sample
+        if h in sample:
+            return
+        heap = self._sample_heap
+        if len(heap) < self.sample_size:
+            heapq.heappush(heap, -h)
+            sample.add(h)
+        elif h < -heap[0]:
+            sample.discard(-heapq.heapreplace(heap, -h))
+            sample.add(h)
+            
+    def _prune(self):
+        floor = heapq.nlargest(self.capacity + 1, self.values())[-1]
+        kept = [(key, count - floor) for key, count in self.items() if count > floor]
+        self.clear()
+        self.update(kept)
+        self.error += floor
+        
+    @property
+    def sample_threshold(self):
+        """Largest sampled hash once the sample is full, else None (sample is exact)"""
+        if len(self._sample_heap) < self.sample_size:
+            return None
+        return -self._sample_heap[0]
+        
+    def merge(self, other):
+        for h in other.sample:
+            self._offer(h)
+        for key, count in other.items():
+            self[key] += count
+        self.error += other.error
+        
+    def most_common(self, n):
+        return sorted(self.items(), key=lambda kv: -kv[1])[:n]
+
+# Defined at module level so partial results can be pickled back from workers
+@dataclass(slots=True)
+class ClusterData:
+    """Per-cluster counters and activity accumulated from the audit log"""
+    request_count: int = 0
+    endpoints: EndpointCounter = field(default_factory=EndpointCounter)
+    verbs: defaultdict = field(default_factory=lambda: defaultdict(int))
+    resources: defaultdict = field(default_factory=lambda: defaultdict(int))
+    watch_streams: list = field(default_factory=list)
+    namespaces_accessed: set = field(default_factory=set)
+    first_seen: str = ''
+    last_seen: str = ''
+
+def approximate_note(endpoints):
+    """Heading suffix explaining pruned endpoint counts, or '' when they are exact"""
+    if not endpoints.error:
+        return ''
+    return f" (approximate: counts are lower bounds, each up to {endpoints.error} low)"
+
+def parse_timestamp(timestamp):
+    """Parse an audit RFC 3339 timestamp into a datetime, or None if invalid"""
+    try:
+        return datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
+    except:
+        return None
+
+@functools.lru_cache(maxsize=4096)
+def _cluster_id_for_username(username):
+    """Map an audit username to a cluster ID (cached; usernames repeat heavily)"""
+    # Cheap substring check first; most usernames never reach the regex
+    if 'cattle-system-' in username:
+        cattle_match = _CATTLE_RE.search(username)
+        if cattle_match:
+            return f"rancher-{cattle_match.group(1)}"
+
+    # System users (kube-scheduler, kube-controller-manager, etc.)
+    if username in _SYSTEM_USERS or username.startswith('system:'):
+        return 'kwok-system'
+
+    return 'unknown'
+
+def _parse_uri_py(base_uri):
+    """Split a request path (query string removed) into
+    (api_group, version, resource, namespaced, namespace)"""
+    api_group = 'core'
+    version = 'v1'
+    resource = 'unknown'
+    namespaced = False
+    namespace = None
+    
+    # Parse API path; at most six segments matter, so stop splitting there
+    parts = base_uri.strip('/').split('/', 6)
+    
+    if len(parts) >= 2:
+        if parts[0] == 'api':
+            # Core API: /api/v1/...
+            version = parts[1]
+            if len(parts) > 2:
+                if parts[2] == 'namespaces' and len(parts) > 3:
+                    namespace = parts[3]
+                    namespaced = True
+                    if len(parts) > 4:
+                        resource = parts[4]
+                    else:
+                        resource = 'namespaces'
+                else:
+                    resource = parts[2]
+                    
+        elif parts[0] == 'apis':
+            # Extended APIs: /apis/group/version/...
+            if len(parts) > 2:
+                api_group = parts[1]
+                version = parts[2]
+                if len(parts) > 3:
+                    if parts[3] == 'namespaces' and len(parts) > 4:
+                        namespace = parts[4]
+                        namespaced = True
+                        if len(parts) > 5:
+                            resource = parts[5]
+                    else:
+                        resource = parts[3]
+    
+    return api_group, version, resource, namespaced, namespace
+
+# Prefer the compiled parser when uri_parse.pyx has been built next to this
+# script (cythonize -i -3 uri_parse.pyx); it mirrors _parse_uri_py exactly
+try:
+    from uri_parse import parse_uri
+except ImportError:
+    parse_uri = _parse_uri_py
+
+@functools.lru_cache(maxsize=65536)
+def _parse_request_uri(base_uri):
+    """Parse a request path (query string removed) into a ResourceInfo (cached)"""
+    api_group, version, resource, namespaced, namespace = parse_uri(base_uri)
+    
+    # Groups, versions and resources come from a small vocabulary; interning
+    # lets every cached ResourceInfo share one string object per name
+    return ResourceInfo(sys.intern(api_group), sys.intern(version), sys.intern(resource),
+                        namespaced, namespace)
 
 class RancherAuditAnalyzer:
     def __init__(self):
-        self.clusters = defaultdict(lambda: {
-            'requests': [],
-            'endpoints': Counter(),
-            'verbs': Counter(),
-            'resources': Counter(),
-            'watch_streams': [],
-            'namespaces_accessed': set(),
-            'first_seen': None,
-            'last_seen': None
-        })
-        self.system_requests = []
+        self.clusters = defaultdict(ClusterData)
+        self.system_request_count = 0
+        self.system_endpoints = EndpointCounter()
+        self.system_verbs = defaultdict(int)
         self.total_requests = 0
         
     def parse_log_line(self, line):
-        """Parse a single audit log line"""
+        """Parse a single audit log line (bytes, surrounding whitespace allowed)"""
         try:
-            return json.loads(line.strip())
+            return json_loads(line)
         except json.JSONDecodeError:
             return None
             
     def extract_cluster_id(self, user_info):
         """Extract Rancher cluster ID from user information"""
-        username = user_info.get('username', '')
-        
-        # Pattern: system:serviceaccount:cattle-system-{cluster_id}:cattle-{cluster_id}
-        cattle_match = re.search(r'cattle-system-([^:]+):cattle-([^:]+)', username)
-        if cattle_match:
-            return f"rancher-{cattle_match.group(1)}"
-        
-        # System users (kube-scheduler, kube-controller-manager, etc.)
-        if username in ['kwok-admin', 'system:apiserver'] or username.startswith('system:'):
-            return 'kwok-system'
-            
-        return 'unknown'
+        return _cluster_id_for_username(user_info.get('username', ''))
     
-    def analyze_request_uri(self, uri):
-        """Analyze request URI to extract resource information"""
-        # Remove query parameters for analysis
-        base_uri = uri.split('?')[0]
-        
-        # Parse API path
-        parts = base_uri.strip('/').split('/')
-        
-        resource_info = {
-            'api_group': 'core',
-            'version': 'v1',
-            'resource': 'unknown',
-            'namespaced': False,
-            'namespace': None
-        }
-        
-        if len(parts) >= 2:
-            if parts[0] == 'api':
-                # Core API: /api/v1/...
-                resource_info['api_group'] = 'core'
-                if len(parts) > 1:
-                    resource_info['version'] = parts[1]
-                if len(parts) > 2:
-                    if parts[2] == 'namespaces' and len(parts) > 3:
-                        resource_info['namespace'] = parts[3]
-                        resource_info['namespaced'] = True
-                        if len(parts) > 4:
-                            resource_info['resource'] = parts[4]
-                        else:
-                            resource_info['resource'] = 'namespaces'
-                    else:
-                        resource_info['resource'] = parts[2]
-                        
-            elif parts[0] == 'apis':
-                # Extended APIs: /apis/group/version/...
-                if len(parts) > 2:
-                    resource_info['api_group'] = parts[1]
-                    resource_info['version'] = parts[2]
-                    if len(parts) > 3:
-                        if parts[3] == 'namespaces' and len(parts) > 4:
-                            resource_info['namespace'] = parts[4]
-                            resource_info['namespaced'] = True
-                            if len(parts) > 5:
-                                resource_info['resource'] = parts[5]
-                        else:
-                            resource_info['resource'] = parts[3]
-        
-        # Parse query parameters
-        query_params = {}
-        if '?' in uri:
-            try:
-                query_params = parse_qs(uri.split('?')[1])
-                # Flatten single-item lists
-                query_params = {k: v[0] if len(v) == 1 else v for k, v in query_params.items()}
-            except:
-                pass
-        
-        resource_info['query_params'] = query_params
-        return resource_info
+    def analyze_request_uri(self, base_uri):
+        """Analyze request path (without query string) to extract resource information"""
+        return _parse_request_uri(base_uri)
     
-    def is_watch_request(self, uri):
-        """Check if this is a watch request"""
-        return 'watch=true' in uri
+    def is_watch_request(self, uri, q):
+        """Check if this is a watch request; q is the index of '?' in uri, or -1"""
+        return q >= 0 and uri.find('watch=true', q + 1) >= 0
         
     def analyze_entry(self, entry):
         """Analyze a single audit log entry"""
@@ -120,195 +294,278 @@ class RancherAuditAnalyzer:
         self.total_requests += 1
         
         # Extract basic info
-        timestamp = entry.get('requestReceivedTimestamp')
+        timestamp = entry.get('requestReceivedTimestamp') or ''
         user = entry.get('user', {})
         uri = entry.get('requestURI', '')
-        verb = entry.get('verb', '')
+        verb = sys.intern(entry.get('verb') or '')
         stage = entry.get('stage', '')
         
         # Only analyze completed requests
-        if stage not in ['ResponseComplete', 'ResponseStarted']:
+        if stage not in _OK_STAGES:
             return
             
         cluster_id = self.extract_cluster_id(user)
-        resource_info = self.analyze_request_uri(uri)
         
-        # Parse timestamp
-        try:
-            ts = datetime.fromisoformat(timestamp.replace('Z', '+00:00'))
-        except:
-            ts = None
-            
-        request_data = {
-            'timestamp': timestamp,
-            'parsed_timestamp': ts,
-            'uri': uri,
-            'verb': verb,
-            'resource_info': resource_info,
-            'user': user.get('username', ''),
-            'user_agent': entry.get('userAgent', ''),
-            'stage': stage
-        }
+        # Locate the query string once; everything below but the watch check
+        # only needs the path
+        q = uri.find('?')
+        base_uri = uri if q < 0 else uri[:q]
+        resource_info = self.analyze_request_uri(base_uri)
         
         if cluster_id == 'kwok-system':
-            self.system_requests.append(request_data)
+            self.system_request_count += 1
+            self.system_endpoints[base_uri] += 1
+            self.system_verbs[verb] += 1
         else:
             cluster_data = self.clusters[cluster_id]
-            cluster_data['requests'].append(request_data)
+            cluster_data.request_count += 1
             
             # Update counters
-            cluster_data['endpoints'][uri.split('?')[0]] += 1
-            cluster_data['verbs'][verb] += 1
+            cluster_data.endpoints[base_uri] += 1
+            cluster_data.verbs[verb] += 1
             
-            resource_key = f"{resource_info['api_group']}/{resource_info['resource']}"
-            cluster_data['resources'][resource_key] += 1
+            resource_key = f"{resource_info.api_group}/{resource_info.resource}"
+            cluster_data.resources[resource_key] += 1
             
-            if resource_info['namespace']:
-                cluster_data['namespaces_accessed'].add(resource_info['namespace'])
+            if resource_info.namespace:
+                cluster_data.namespaces_accessed.add(resource_info.namespace)
                 
-            # Track watch streams
-            if self.is_watch_request(uri):
-                cluster_data['watch_streams'].append(request_data)
+            # Track watch streams (the only per-request detail we keep)
+            if self.is_watch_request(uri, q):
+                cluster_data.watch_streams.append({
+                    'timestamp': timestamp,
+                    'verb': verb,
+                    'resource_info': resource_info
+                })
                 
-            # Update timestamps
-            if ts:
-                if not cluster_data['first_seen'] or ts < cluster_data['first_seen']:
-                    cluster_data['first_seen'] = ts
-                if not cluster_data['last_seen'] or ts > cluster_data['last_seen']:
-                    cluster_data['last_seen'] = ts
+            # Update timestamps. Audit timestamps are uniform RFC 3339 strings
+            # (microseconds, 'Z'), so they order correctly as plain strings and
+            # are only parsed for display in print_summary. Logs are mostly in
+            # order, so the common case is one compare; '' (unset or missing)
+            # sorts below every timestamp.
+            if timestamp > cluster_data.last_seen:
+                cluster_data.last_seen = timestamp
+                if not cluster_data.first_seen:
+                    cluster_data.first_seen = timestamp
+            elif timestamp and timestamp < cluster_data.first_seen:
+                cluster_data.first_seen = timestamp
     
-    def analyze_file(self, filename):
-        """Analyze audit log file"""
-        print(f"Analyzing audit log: {filename}")
-        
-        with open(filename, 'r') as f:
-            for line_num, line in enumerate(f, 1):
+    def analyze_lines(self, lines, report_progress=True):
+        """Analyze an iterable of raw (bytes) audit log lines"""
+        line_num = 0
+        for line_num, line in enumerate(lines, 1):
+            if line.find(_REQUEST_RECEIVED, 0, _STAGE_SCAN_BYTES) >= 0:
+                # Counted like any other entry, but never analyzed
+                self.total_requests += 1
+            else:
                 entry = self.parse_log_line(line)
                 if entry:
                     self.analyze_entry(entry)
-                    
-                if line_num % 1000 == 0:
-                    print(f"Processed {line_num} lines...")
+                
+            # Progress goes to stderr, rarely, so it neither slows the loop
+            # nor mixes into a piped report
+            if report_progress and line_num % 100000 == 0:
+                print(f"Processed {line_num} lines...", file=sys.stderr, flush=False)
+        return line_num
+    
+    def merge(self, other):
+        """Merge a partial analysis of a later part of the log into this one"""
+        self.total_requests += other.total_requests
+        self.system_request_count += other.system_request_count
+        self.system_endpoints.merge(other.system_endpoints)
+        for verb, count in other.system_verbs.items():
+            self.system_verbs[verb] += count
+            
+        for cluster_id, theirs in other.clusters.items():
+            ours = self.clusters[cluster_id]
+            ours.request_count += theirs.request_count
+            ours.endpoints.merge(theirs.endpoints)
+            for key in ('verbs', 'resources'):
+                counts = getattr(ours, key)
+                for name, count in getattr(theirs, key).items():
+                    counts[name] += count
+            ours.watch_streams.extend(theirs.watch_streams)
+            ours.namespaces_accessed |= theirs.namespaces_accessed
+            if theirs.first_seen and (not ours.first_seen or theirs.first_seen < ours.first_seen):
+                ours.first_seen = theirs.first_seen
+            if theirs.last_seen > ours.last_seen:
+                ours.last_seen = theirs.last_seen
+    
+    def analyze_file(self, filename, workers=None):
+        """Analyze audit log file, splitting large files across worker processes"""
+        print(f"Analyzing audit log: {filename}")
+        
+        if workers is None:
+            workers = os.cpu_count() or 1
+            
+        with open(filename, 'rb') as f:
+            st = os.fstat(f.fileno())
+            if not stat.S_ISREG(st.st_mode):
+                # Pipes, /dev/stdin, <(zcat ...) and the like cannot be mapped
+                self.analyze_lines(f)
+            # mmap refuses empty files; there is nothing to analyze anyway
+            elif st.st_size:
+                size = st.st_size
+                with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+                    bounds = chunk_bounds(mm, workers) if size >= PARALLEL_MIN_BYTES else [(0, size)]
+                    if len(bounds) == 1:
+                        self.analyze_lines(iter_lines(mm))
+                    else:
+                        # Workers re-map the file themselves; results come back
+                        # in file order so merged ordering matches a serial run
+                        line_total = 0
+                        with multiprocessing.Pool(len(bounds)) as pool:
+                            tasks = [(filename, start, end) for start, end in bounds]
+                            for partial, line_count in pool.imap(_analyze_chunk, tasks):
+                                self.merge(partial)
+                                line_total += line_count
+                                print(f"Processed {line_total} lines...", file=sys.stderr, flush=False)
         
         print(f"Analysis complete. Processed {self.total_requests} total requests.")
     
     def print_summary(self):
         """Print analysis summary"""
-        print("\n" + "="*80)
-        print("RANCHER MULTI-CLUSTER AUDIT LOG ANALYSIS")
-        print("="*80)
+        # Build the whole report in memory and write it out once
+        buf = io.StringIO()
+        
+        print("\n" + "="*80, file=buf)
+        print("RANCHER MULTI-CLUSTER AUDIT LOG ANALYSIS", file=buf)
+        print("="*80, file=buf)
         
-        print(f"\nTotal Requests Analyzed: {self.total_requests}")
-        print(f"Rancher Clusters Detected: {len(self.clusters)}")
-        print(f"System Requests: {len(self.system_requests)}")
+        print(f"\nTotal Requests Analyzed: {self.total_requests}", file=buf)
+        print(f"Rancher Clusters Detected: {len(self.clusters)}", file=buf)
+        print(f"System Requests: {self.system_request_count}", file=buf)
         
         # Cluster analysis
         for cluster_id, data in self.clusters.items():
-            print(f"\n{'─'*60}")
-            print(f"CLUSTER: {cluster_id}")
-            print(f"{'─'*60}")
+            print(f"\n{'─'*60}", file=buf)
+            print(f"CLUSTER: {cluster_id}", file=buf)
+            print(f"{'─'*60}", file=buf)
             
-            print(f"Total Requests: {len(data['requests'])}")
+            print(f"Total Requests: {data.request_count}", file=buf)
             
-            if data['first_seen'] and data['last_seen']:
-                duration = data['last_seen'] - data['first_seen']
-                print(f"Activity Period: {data['first_seen'].strftime('%Y-%m-%d %H:%M:%S')} → {data['last_seen'].strftime('%Y-%m-%d %H:%M:%S')}")
-                print(f"Duration: {duration}")
+            first_seen = parse_timestamp(data.first_seen)
+            last_seen = parse_timestamp(data.last_seen)
+            if first_seen and last_seen:
+                duration = last_seen - first_seen
+                print(f"Activity Period: {first_seen.strftime('%Y-%m-%d %H:%M:%S')} → {last_seen.strftime('%Y-%m-%d %H:%M:%S')}", file=buf)
+                print(f"Duration: {duration}", file=buf)
                 
                 if duration.total_seconds() > 0:
-                    req_per_minute = len(data['requests']) / (duration.total_seconds() / 60)
-                    print(f"Request Rate: {req_per_minute:.2f} requests/minute")
+                    req_per_minute = data.request_count / (duration.total_seconds() / 60)
+                    print(f"Request Rate: {req_per_minute:.2f} requests/minute", file=buf)
             
-            print(f"\nTop 10 API Endpoints:")
-            for endpoint, count in data['endpoints'].most_common(10):
-                print(f"  {count:4d} - {endpoint}")
+            print(f"\nTop 10 API Endpoints{approximate_note(data.endpoints)}:", file=buf)
+            for endpoint, count in data.endpoints.most_common(10):
+                print(f"  {count:4d} - {endpoint}", file=buf)
             
-            print(f"\nHTTP Verbs:")
-            for verb, count in data['verbs'].most_common():
-                print(f"  {verb:8s}: {count:4d}")
+            print(f"\nHTTP Verbs:", file=buf)
+            for verb, count in Counter(data.verbs).most_common():
+                print(f"  {verb:8s}: {count:4d}", file=buf)
             
-            print(f"\nTop Resources:")
-            for resource, count in data['resources'].most_common(10):
-                print(f"  {count:4d} - {resource}")
+            print(f"\nTop Resources:", file=buf)
+            for resource, count in Counter(data.resources).most_common(10):
+                print(f"  {count:4d} - {resource}", file=buf)
                 
-            print(f"\nNamespaces Accessed: {len(data['namespaces_accessed'])}")
-            if data['namespaces_accessed']:
-                ns_list = sorted(data['namespaces_accessed'])
-                print(f"  {', '.join(ns_list)}")
+            print(f"\nNamespaces Accessed: {len(data.namespaces_accessed)}", file=buf)
+            if data.namespaces_accessed:
+                ns_list = sorted(data.namespaces_accessed)
+                print(f"  {', '.join(ns_list)}", file=buf)
             
-            print(f"\nWatch Streams: {len(data['watch_streams'])}")
-            if data['watch_streams']:
-                print("  Active watch streams:")
-                for watch in data['watch_streams'][-5:]:  # Show last 5
-                    resource = watch['resource_info']['resource']
-                    print(f"    - {watch['verb']} {resource} ({watch['timestamp']})")
+            print(f"\nWatch Streams: {len(data.watch_streams)}", file=buf)
+            if data.watch_streams:
+                print("  Active watch streams:", file=buf)
+                for watch in data.watch_streams[-5:]:  # Show last 5
+                    resource = watch['resource_info'].resource
+                    print(f"    - {watch['verb']} {resource} ({watch['timestamp']})", file=buf)
         
         # System requests summary
-        if self.system_requests:
-            print(f"\n{'─'*60}")
-            print(f"KWOK SYSTEM REQUESTS")
-            print(f"{'─'*60}")
-            
-            system_endpoints = Counter()
-            system_verbs = Counter()
+        if self.system_request_count:
+            print(f"\n{'─'*60}", file=buf)
+            print(f"KWOK SYSTEM REQUESTS", file=buf)
+            print(f"{'─'*60}", file=buf)
             
-            for req in self.system_requests:
-                system_endpoints[req['uri'].split('?')[0]] += 1
-                system_verbs[req['verb']] += 1
-            
-            print(f"Total System Requests: {len(self.system_requests)}")
-            print(f"\nTop System Endpoints:")
-            for endpoint, count in system_endpoints.most_common(10):
-                print(f"  {count:4d} - {endpoint}")
+            print(f"Total System Requests: {self.system_request_count}", file=buf)
+            print(f"\nTop System Endpoints{approximate_note(self.system_endpoints)}:", file=buf)
+            for endpoint, count in self.system_endpoints.most_common(10):
+                print(f"  {count:4d} - {endpoint}", file=buf)
+        
+        sys.stdout.write(buf.getvalue())
     
     def detect_issues(self):
         """Detect potential issues with the setup"""
-        print(f"\n{'─'*60}")
-        print("ISSUE DETECTION")
-        print(f"{'─'*60}")
+        buf = io.StringIO()
+        
+        print(f"\n{'─'*60}", file=buf)
+        print("ISSUE DETECTION", file=buf)
+        print(f"{'─'*60}", file=buf)
         
         issues = []
         
         # Check if multiple clusters are accessing the same resources
         if len(self.clusters) > 1:
-            # Check for overlapping namespaces
-            all_namespaces = set()
-            cluster_namespaces = {}
-            
+            # Check for overlapping namespaces (one pass over memberships)
+            namespace_clusters = defaultdict(list)
             for cluster_id, data in self.clusters.items():
-                cluster_namespaces[cluster_id] = data['namespaces_accessed']
-                all_namespaces.update(data['namespaces_accessed'])
+                for ns in data.namespaces_accessed:
+                    namespace_clusters[ns].append(cluster_id)
             
-            # Find overlapping namespaces
-            for ns in all_namespaces:
-                accessing_clusters = [cid for cid, nss in cluster_namespaces.items() if ns in nss]
+            # Sorted so the report does not depend on set order (hash seed,
+            # or how partial results were merged)
+            for ns in sorted(namespace_clusters):
+                accessing_clusters = namespace_clusters[ns]
                 if len(accessing_clusters) > 1:
                     issues.append(f"Namespace '{ns}' accessed by multiple clusters: {', '.join(accessing_clusters)}")
             
-            # Check if clusters see identical resources
-            endpoint_sets = {}
+            # Check if clusters see identical resources, using each cluster's
+            # bottom-k sample of endpoint hashes. Bits are assigned in hash
+            # order, so "hashes up to t" is a low-bit mask and pairwise overlap
+            # is a single AND.
+            all_hashes = sorted(set().union(*(data.endpoints.sample for data in self.clusters.values())))
+            hash_bits = {h: bit for bit, h in enumerate(all_hashes)}
+            endpoint_masks = {}
             for cluster_id, data in self.clusters.items():
-                endpoint_sets[cluster_id] = set(data['endpoints'].keys())
+                mask = 0
+                for h in data.endpoints.sample:
+                    mask |= 1 << hash_bits[h]
+                endpoint_masks[cluster_id] = (mask, data.endpoints.sample_threshold)
             
-            cluster_ids = list(endpoint_sets.keys())
+            cluster_ids = list(endpoint_masks.keys())
             for i, cluster1 in enumerate(cluster_ids):
+                mask1, threshold1 = endpoint_masks[cluster1]
                 for cluster2 in cluster_ids[i+1:]:
-                    overlap = endpoint_sets[cluster1] & endpoint_sets[cluster2]
-                    if len(overlap) > 5:  # Significant overlap
-                        overlap_pct = len(overlap) / len(endpoint_sets[cluster1] | endpoint_sets[cluster2]) * 100
+                    mask2, threshold2 = endpoint_masks[cluster2]
+                    thresholds = [t for t in (threshold1, threshold2) if t is not None]
+                    if thresholds:
+                        # Full samples only cover hashes up to their threshold;
+                        # compare both below the lower one and scale up the
+                        # overlap count from that fraction of hash space
+                        threshold = min(thresholds)
+                        low_bits = (1 << (hash_bits[threshold] + 1)) - 1
+                        mask1_cut, mask2_cut = mask1 & low_bits, mask2 & low_bits
+                        shared = (mask1_cut & mask2_cut).bit_count()
+                        union = (mask1_cut | mask2_cut).bit_count()
+                        overlap = shared * (2 ** 64 / (threshold + 1))
+                    else:
+                        shared = overlap = (mask1 & mask2).bit_count()
+                        union = (mask1 | mask2).bit_count()
+                    if overlap > 5:  # Significant overlap
+                        overlap_pct = shared / union * 100
                         issues.append(f"High endpoint overlap ({overlap_pct:.1f}%) between {cluster1} and {cluster2}")
         
         if issues:
-            print("\n⚠️  POTENTIAL ISSUES DETECTED:")
+            print("\n⚠️  POTENTIAL ISSUES DETECTED:", file=buf)
             for i, issue in enumerate(issues, 1):
-                print(f"  {i}. {issue}")
+                print(f"  {i}. {issue}", file=buf)
             
-            print(f"\n💡 RECOMMENDATIONS:")
-            print("  - Multiple Rancher clusters seeing identical resources indicates lack of isolation")
-            print("  - Consider using separate KWOK instances for true cluster isolation")
-            print("  - Or implement API filtering proxy to provide different views per cluster")
+            print(f"\n💡 RECOMMENDATIONS:", file=buf)
+            print("  - Multiple Rancher clusters seeing identical resources indicates lack of isolation", file=buf)
+            print("  - Consider using separate KWOK instances for true cluster isolation", file=buf)
+            print("  - Or implement API filtering proxy to provide different views per cluster", file=buf)
         else:
-            print("\n✅ No obvious issues detected")
+            print("\n✅ No obvious issues detected", file=buf)
+            
+        sys.stdout.write(buf.getvalue())
 
 def main():
     if len(sys.argv) != 2:
@@ -0,0 +1,84 @@
+# cython: language_level=3, boundscheck=False, wraparound=False
+"""
+Compiled request-path parser for audit-run.py
+Build in place with: cythonize -i -3 uri_parse.pyx
+"""
+
+# Only the first six path segments are ever inspected
+cdef enum:
+    MAX_SEGMENTS = 6
+
+cpdef tuple parse_uri(str base_uri):
+    """Split a request path (query string removed) into
+    (api_group, version, resource, namespaced, namespace)"""
+    cdef Py_ssize_t start = 0
+    cdef Py_ssize_t end = len(base_uri)
+    cdef Py_ssize_t i
+    cdef Py_ssize_t starts[MAX_SEGMENTS]
+    cdef Py_ssize_t ends[MAX_SEGMENTS]
+    cdef int count = 0
+    cdef int nparts
+    cdef bint more = False
+    
+    api_group = 'core'
+    version = 'v1'
+    resource = 'unknown'
+    namespaced = False
+    namespace = None
+    
+    # Same as base_uri.strip('/')
+    while start < end and base_uri[start] == u'/':
+        start += 1
+    while end > start and base_uri[end - 1] == u'/':
+        end -= 1
+        
+    # Record segment boundaries as split('/') would, stopping once
+    # MAX_SEGMENTS are known and noting whether more follow
+    starts[0] = start
+    i = start
+    while True:
+        if i == end or base_uri[i] == u'/':
+            ends[count] = i
+            count += 1
+            if i == end:
+                break
+            if count == MAX_SEGMENTS:
+                more = True
+                break
+            starts[count] = i + 1
+        i += 1
+    nparts = count + more
+    
+    if nparts >= 2:
+        root = base_uri[starts[0]:ends[0]]
+        if root == 'api':
+            # Core API: /api/v1/...
+            version = base_uri[starts[1]:ends[1]]
+            if nparts > 2:
+                segment = base_uri[starts[2]:ends[2]]
+                if segment == 'namespaces' and nparts > 3:
+                    namespace = base_uri[starts[3]:ends[3]]
+                    namespaced = True
+                    if nparts > 4:
+                        resource = base_uri[starts[4]:ends[4]]
+                    else:
+                        resource = 'namespaces'
+                else:
+                    resource = segment
+                    
+        elif root == 'apis':
+            # Extended APIs: /apis/group/version/...
+            if nparts > 2:
+                api_group = base_uri[starts[1]:ends[1]]
+                version = base_uri[starts[2]:ends[2]]
+                if nparts > 3:
+                    segment = base_uri[starts[3]:ends[3]]
+                    if segment == 'namespaces' and nparts > 4:
+                        namespace = base_uri[starts[4]:ends[4]]
+                        namespaced = True
+                        if nparts > 5:
+                            resource = base_uri[starts[5]:ends[5]]
+                    else:
+                        resource = segment
+    
+    return api_group, version, resource, namespaced, namespace